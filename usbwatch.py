@@ -5,20 +5,34 @@ import traceback
 import argparse
 import sys
 import os
+import re
 import fcntl
+import errno
+import time
+import struct
 import glob
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from ctypes import (
-    c_uint8, c_uint16, c_uint32, POINTER,
-    sizeof, addressof, LittleEndianStructure)
+    c_uint8, c_uint16, c_uint32, c_int, c_uint, c_ulong, c_void_p, POINTER,
+    sizeof, addressof, create_string_buffer, get_errno, CDLL,
+    LittleEndianStructure)
 
 import usb.core
 from serial.tools import list_ports
 
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
 # control transfer timeout
 USB_TIMEOUT =  5000
 
+# seconds a usb enumeration is reused before rescanning
+PORTS_CACHE_TTL = 1.5
+
 # usb classes codes
 USB_CLASS_HUB =          0x09
 
@@ -52,6 +66,12 @@ USB_RECIP_DEVICE =       0x00
 USB_RECIP_OTHER =        0x03
 USBDEVFS_CONTROL =       0x0c0185500
 USBDEVFS_RESET =         0x5514
+USBDEVFS_FORBID_SUSPEND = 0x5521
+USBDEVFS_ALLOW_SUSPEND = 0x5522
+USBDEVFS_SUBMITURB =     0x8038550a
+USBDEVFS_DISCARDURB =    0x550b
+USBDEVFS_REAPURBNDELAY = 0x4008550d
+USBDEVFS_URB_TYPE_CONTROL = 2
 
 # usb iotcl requests
 USB_REQ_GET_DESCRIPTOR = 0x06
@@ -63,24 +83,31 @@ USB_REQ_CLEAR_FEATURE =  0x01
 # helper functions
 ###########################
 
-def find(data, name, value):
-    for d in data:
-        if d.get(name) == value:
-            return d
+def quote_attr(value):
+    return escape(value, {'"': '&quot;', '\n': '&#10;'})
+
+# a string index of zero means the device has no such string,
+# skip the control transfer that pyusb would make only to fail
 
 def device_serial(dev):
+    if not dev.iSerialNumber:
+        return None
     try:
         return dev.serial_number
     except:
         pass
 
 def device_product(dev):
+    if not dev.iProduct:
+        return None
     try:
         return dev.product
     except ValueError as e:
         pass
 
 def device_manufacturer(dev):
+    if not dev.iManufacturer:
+        return None
     try:
         return dev.manufacturer
     except ValueError as e:
@@ -101,11 +128,78 @@ class usbdevfs_ctrltransfer(LittleEndianStructure):
         ("data", POINTER(None))
     ]
 
+class usbdevfs_urb(LittleEndianStructure):
+    _fields_ = [
+        ('type', c_uint8),
+        ('endpoint', c_uint8),
+        ('status', c_int),
+        ('flags', c_uint),
+        ('buffer', c_void_p),
+        ('buffer_length', c_int),
+        ('actual_length', c_int),
+        ('start_frame', c_int),
+        ('number_of_packets', c_int),
+        ('error_count', c_int),
+        ('signr', c_uint),
+        ('usercontext', c_void_p)
+    ]
+
+# usb_ctrlrequest: bRequestType, bRequest, wValue, wIndex, wLength
+USB_CTRLREQUEST = struct.Struct('<BBHHH')
+
+# usb_port_status: wPortStatus, wPortChange
+USB_PORT_STATUS = struct.Struct('<HH')
+
+# usb_hub_descriptor: bDescLength, bDescriptorType, bNbrPorts,
+# wHubCharacteristics, bPwrOn2PwrGood, bHubContrCurrent
+USB_HUB_DESCRIPTOR = struct.Struct('<BBBHBB')
+
+# transfer block and buffers reused by the synchronous hub requests,
+# the servers handle one request at a time
+_CTRL = usbdevfs_ctrltransfer()
+_STATUS_BUF = create_string_buffer(USB_PORT_STATUS.size)
+_HUB_BUF = create_string_buffer(USB_HUB_DESCRIPTOR.size)
+
+# port status flag characters in display order, by usb level
+FLAG_CHARS = (
+    (USB_PORT_STAT_CONNECTION, 'C'),
+    (USB_PORT_STAT_ENABLE, 'E'),
+    (USB_PORT_STAT_RESET, 'R'),
+    (USB_PORT_STAT_SUSPEND, 'S'),
+)
+FLAGS_USB2 = ((USB_PORT_STAT_POWER, 'P'),) + FLAG_CHARS
+FLAGS_USB3 = ((USB_PORT_STAT_POWER_SS, 'P'),) + FLAG_CHARS
+
+def port_status_flags(port_status, usb_level):
+    if usb_level <= 2:
+        table = FLAGS_USB2
+    elif usb_level == 3:
+        table = FLAGS_USB3
+    else:
+        table = FLAG_CHARS
+    return ''.join([c for m, c in table if port_status & m])
+
 def usb_reset(fd):
     fcntl.ioctl(fd, USBDEVFS_RESET, 0)
 
+# an open usbfs file keeps its device awake unless suspend is allowed,
+# kernels without these ioctls simply keep it awake as before
+
+def usb_forbid_suspend(fd):
+    try:
+        fcntl.ioctl(fd, USBDEVFS_FORBID_SUSPEND, 0)
+    except OSError as e:
+        if e.errno not in (errno.ENOTTY, errno.EINVAL):
+            raise
+
+def usb_allow_suspend(fd):
+    try:
+        fcntl.ioctl(fd, USBDEVFS_ALLOW_SUSPEND, 0)
+    except OSError:
+        pass
+
 def usb_hub_feature(fd, portnum, feature, value):
-    ctrl = usbdevfs_ctrltransfer()
+    ctrl = _CTRL
     ctrl.bRequestType = USB_DIR_OUT | USB_TYPE_CLASS | USB_RECIP_OTHER
     ctrl.bRequest = USB_REQ_SET_FEATURE if value else USB_REQ_CLEAR_FEATURE
     ctrl.wValue = feature
@@ -116,60 +210,111 @@ def usb_hub_feature(fd, portnum, feature, value):
     fcntl.ioctl(fd, USBDEVFS_CONTROL, ctrl)
 
 def usb_hub_port_status(fd, portnum, usb_level):
-    class usb_port_status (LittleEndianStructure):
-        _pack_ = 1
-        _fields_ = [
-            ('wPortStatus', c_uint16),
-            ('wPortChange', c_uint16),
-        ]
-    data = usb_port_status()
-    ctrl = usbdevfs_ctrltransfer()
+    data = _STATUS_BUF
+    ctrl = _CTRL
     ctrl.bRequestType = USB_DIR_IN | USB_TYPE_CLASS | USB_RECIP_OTHER
     ctrl.bRequest = USB_REQ_GET_STATUS
     ctrl.wValue = 0
     ctrl.wIndex = portnum
-    ctrl.wLength = sizeof(usb_port_status)
+    ctrl.wLength = USB_PORT_STATUS.size
     ctrl.timeout = USB_TIMEOUT
     ctrl.data = addressof(data)
     fcntl.ioctl(fd, USBDEVFS_CONTROL, ctrl)
-    pstat = usb_port_status.from_buffer_copy(data)
-    port_status = pstat.wPortStatus
+    port_status, _ = USB_PORT_STATUS.unpack_from(data)
+    return port_status_flags(port_status, usb_level)
+
+# fcntl.ioctl only takes an int or a buffer it copies, but urb ioctls
+# need the real address since the kernel writes back to it later
+_libc = CDLL(None, use_errno=True)
+_libc.ioctl.argtypes = [c_int, c_ulong, c_void_p]
+_libc.ioctl.restype = c_int
+
+def usb_ioctl_ptr(fd, request, address):
+    if _libc.ioctl(fd.fileno(), request, address) < 0:
+        err = get_errno()
+        raise OSError(err, os.strerror(err))
+
+# urbs the kernel never gave back, their memory must stay allocated
+_LOST_URBS = []
+
+def usb_reap_urbs(fd, pending, timeout):
+    # completed urbs make the usbfs file descriptor writable
+    poller = select.poll()
+    poller.register(fd, select.POLLOUT)
+    deadline = time.monotonic() + timeout / 1000
+    ptr = c_void_p()
+    while pending:
+        try:
+            usb_ioctl_ptr(fd, USBDEVFS_REAPURBNDELAY, addressof(ptr))
+            pending.discard(ptr.value)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not poller.poll(remaining * 1000):
+                return False
+    return True
+
+def usb_hub_port_statuses(fd, numports, usb_level):
+    # submit every port status request at once and then reap them,
+    # rather than one blocking control transfer per port
+    urbs = []
+    for portnum in range(1, numports + 1):
+        # a control urb buffer holds the setup packet then the data stage
+        buf = create_string_buffer(USB_CTRLREQUEST.size + USB_PORT_STATUS.size)
+        USB_CTRLREQUEST.pack_into(buf, 0,
+            USB_DIR_IN | USB_TYPE_CLASS | USB_RECIP_OTHER,
+            USB_REQ_GET_STATUS, 0, portnum, USB_PORT_STATUS.size)
+        urb = usbdevfs_urb()
+        urb.type = USBDEVFS_URB_TYPE_CONTROL
+        urb.endpoint = 0
+        urb.buffer = addressof(buf)
+        urb.buffer_length = sizeof(buf)
+        urbs.append((urb, buf))
+    pending = set()
+    try:
+        for urb, buf in urbs:
+            # pass the address, the kernel writes back into the urb itself
+            usb_ioctl_ptr(fd, USBDEVFS_SUBMITURB, addressof(urb))
+            pending.add(addressof(urb))
+        if not usb_reap_urbs(fd, pending, USB_TIMEOUT):
+            raise OSError(errno.ETIMEDOUT, 'hub port status timed out')
+    finally:
+        if pending:
+            for address in pending:
+                try:
+                    usb_ioctl_ptr(fd, USBDEVFS_DISCARDURB, address)
+                except OSError:
+                    pass
+            try:
+                reaped = usb_reap_urbs(fd, pending, USB_TIMEOUT)
+            except OSError:
+                reaped = False
+            if not reaped:
+                _LOST_URBS.append(urbs)
     res = []
-    if usb_level <= 2: 
-        if port_status & USB_PORT_STAT_POWER: res.append('P')
-    if usb_level == 3:
-        if port_status & USB_PORT_STAT_POWER_SS: res.append('P')
-    if port_status & USB_PORT_STAT_CONNECTION: res.append('C')
-    if port_status & USB_PORT_STAT_ENABLE: res.append('E')
-    if port_status & USB_PORT_STAT_RESET: res.append('R')
-    if port_status & USB_PORT_STAT_SUSPEND: res.append('S')
+    for urb, buf in urbs:
+        if urb.status:
+            raise OSError(-urb.status, os.strerror(-urb.status))
+        port_status, _ = USB_PORT_STATUS.unpack_from(buf, USB_CTRLREQUEST.size)
+        res.append(port_status_flags(port_status, usb_level))
     return res
 
 def usb_hub_numports(fd, usb_level):
-    class usb_hub_descriptor(LittleEndianStructure):
-        _pack_ = 1
-        _fields_ = [
-            ('bDescLength', c_uint8),
-            ('bDescriptorType', c_uint8),
-            ('bNbrPorts', c_uint8),            # number of ports
-            ('wHubCharacteristics', c_uint16), # power switching, overcurrent
-            ('bPwrOn2PwrGood', c_uint8),       # time to power good (2ms)
-            ('bHubContrCurrent', c_uint8)      # max current used (mA)
-        ]
-    data = usb_hub_descriptor()
+    data = _HUB_BUF
     desc_type = USB_DT_SUPERSPEED_HUB if usb_level >= 3 else USB_DT_HUB 
-    ctrl = usbdevfs_ctrltransfer()
+    ctrl = _CTRL
     ctrl.bRequestType = USB_DIR_IN | USB_TYPE_CLASS | USB_RECIP_DEVICE
     ctrl.bRequest = USB_REQ_GET_DESCRIPTOR
     ctrl.wValue = desc_type << 8
     ctrl.wIndex = 0
-    ctrl.wLength = sizeof(usb_hub_descriptor)
+    ctrl.wLength = USB_HUB_DESCRIPTOR.size
     ctrl.timeout = USB_TIMEOUT
     ctrl.data = addressof(data)
     try:
         fcntl.ioctl(fd, USBDEVFS_CONTROL, ctrl)
-        hub_descriptor = usb_hub_descriptor.from_buffer_copy(data)
-        return hub_descriptor.bNbrPorts
+        _, _, numports, _, _, _ = USB_HUB_DESCRIPTOR.unpack_from(data)
+        return numports
     except Exception:
         pass
 
@@ -177,22 +322,39 @@ def usb_hub_numports(fd, usb_level):
 # dev routines
 ###########################
 
-def usb_filename(dev):
-    filename = f'/dev/bus/usb/{dev.bus:03d}/{dev.address:03d}'
+def usb_filename(bus, address):
+    filename = f'/dev/bus/usb/{bus:03d}/{address:03d}'
     if not os.path.exists(filename):
         raise ValueError(f'usb device not found: {filename}')
     return filename
 
-def usb_disable_port(dev, port):
+def sysfs_read(name, attr):
     try:
-        cfg = dev.get_active_configuration()
-        conf = cfg.bConfigurationValue
-    except:
-        raise ValueError('could not get configuration')
-    bus = dev.bus
-    port_numbers = dev.port_numbers or ()
-    port_numbers = '.'.join(f'{n:d}' for n in port_numbers)
+        with open(f'/sys/bus/usb/devices/{name}/{attr}') as fd:
+            return fd.read().strip()
+    except OSError:
+        pass  # missing, or the device was just removed
+
+def sysfs_device(location):
+    # returns (bus, address, number of hub ports) without enumerating usb
+    bus = location[0]
+    port_numbers = '.'.join(f'{n:d}' for n in location[1:])
+    name = f'{bus}-{port_numbers}' if port_numbers else f'usb{bus}'
+    res = [sysfs_read(name, attr) for attr in ('busnum', 'devnum', 'maxchild')]
+    if None in res:
+        return None
+    return tuple(int(n) for n in res)
+
+def usb_disable_port(location):
+    bus = location[0]
+    port = location[-1]
+    port_numbers = '.'.join(f'{n:d}' for n in location[1:-1])
     hub = f'{bus}-{port_numbers}' if port_numbers else f'{bus}'
+    name = hub if port_numbers else f'usb{bus}'
+    try:
+        conf = int(sysfs_read(name, 'bConfigurationValue'))
+    except (OSError, TypeError, ValueError):
+        raise ValueError('could not get configuration')
     if port_numbers:
         filename = f'/sys/bus/usb/devices/{hub}:{conf}.0/{hub}-port{port}/disable'
     else:
@@ -206,98 +368,203 @@ def usb_disable_port(dev, port):
 # list usb ports
 ###########################
 
+class Port:
+    __slots__ = (
+        'bus', 'port_number', 'address', 'vidpid', 'location',
+        'usb_level', 'serial_number', 'product', 'manufacturer',
+        'is_hub', 'numports', 'port_status', 'name')
+
+    def __init__(self, **kw):
+        for name in self.__slots__:
+            setattr(self, name, kw.pop(name, None))
+        if kw:
+            raise TypeError(f'unknown port fields: {", ".join(kw)}')
+
+# bus-port.port..., optionally followed by :config.interface; only plain
+# digits are accepted, no signs, underscores or spaces inside a number
+LOCATION_RE = re.compile(r'\s*(\d+)\s*(?:-\s*(\d+(?:\.\d+)*)?)?\s*(?::.*)?', re.S)
+
 def parse_location(location):
-    location = location.split(':')[0]
-    bus, _, port_numbers = location.partition('-')
-    bus = bus.strip()
-    port_numbers = port_numbers.strip()
-    try:
-        location = (int(bus),) 
-        if port_numbers:
-            port_numbers = port_numbers.split('.')
-            port_numbers = tuple(int(d) for d in port_numbers)
-            location += port_numbers
-        return location
-    except ValueError:
+    m = LOCATION_RE.fullmatch(location)
+    if m is None:
         raise ValueError('bad usb port location')
+    bus, port_numbers = m.groups()
+    if port_numbers:
+        return (int(bus),) + tuple(map(int, port_numbers.split('.')))
+    return (int(bus),)
 
-def update_comports(ports):
+def update_comports(index):
     for info in list_ports.comports():
         if info.vid is not None and info.pid is not None:
             location = parse_location(info.location)
-            d = find(ports, 'location', location)
+            d = index.get(location)
             if d:
-                if d.get('name'):
-                    d['name'] = f'{d["name"]} {info.name}' 
+                if d.name:
+                    d.name = f'{d.name} {info.name}' 
                 else:
-                    d['name'] = info.name
-
-def update_hubs(ports):
+                    d.name = info.name
+
+_HUB_FDS = {}
+
+def hub_file(bus, address):
+    key = (bus, address)
+    fd = _HUB_FDS.get(key)
+    if fd is None:
+        # write access required to perform control transfer
+        fd = _HUB_FDS[key] = open(usb_filename(bus, address), 'w+')
+        # let runtime pm suspend the hub between uses
+        usb_allow_suspend(fd)
+    return fd
+
+def close_hub_file(bus, address):
+    fd = _HUB_FDS.pop((bus, address), None)
+    if fd is not None:
+        fd.close()
+
+def update_hubs(ports, index):
+    hubs = set()
     for d in list(ports):
-        if d.get('is_hub'):
-            usb_level = d['usb_level']
-            location = d['location']
-            # write access required to perform control transfer
-            with open(usb_filename(d['dev']), 'w+') as fd:
-                numports = usb_hub_numports(fd, usb_level)
-                if numports is None:
-                    continue
-                d['numports'] = numports
-                for portnum in range(1, numports + 1):
-                    port_status = usb_hub_port_status(fd, portnum, usb_level)
-                    port_location = location + (portnum,)
-                    res = find(ports, 'location', port_location)
-                    if res:
-                        res['port_status'] = port_status
-                    else:
-                        ports.append({ 
-                            'location': port_location, 
-                            'port_status': port_status,
-                        })
+        if d.is_hub:
+            usb_level = d.usb_level
+            location = d.location
+            hubs.add((d.bus, d.address))
+            try:
+                fd = hub_file(d.bus, d.address)
+                usb_forbid_suspend(fd)
+                try:
+                    numports = usb_hub_numports(fd, usb_level)
+                    if numports is None:
+                        continue
+                    statuses = usb_hub_port_statuses(fd, numports, usb_level)
+                finally:
+                    usb_allow_suspend(fd)
+            except OSError:
+                # the hub went away, do not keep a stale descriptor
+                close_hub_file(d.bus, d.address)
+                raise
+            d.numports = numports
+            for portnum, port_status in enumerate(statuses, 1):
+                port_location = location + (portnum,)
+                res = index.get(port_location)
+                if res:
+                    res.port_status = port_status
+                else:
+                    res = Port(
+                        location=port_location, 
+                        port_status=port_status)
+                    ports.append(res)
+                    index[port_location] = res
+    for key in set(_HUB_FDS) - hubs:
+        close_hub_file(*key)
+
+_PORTS_CACHE = {'ts': 0, 'data': None}
+
+def invalidate_usbports():
+    _PORTS_CACHE['data'] = None
 
 def list_usbports():
-    ports = []
-    for dev in usb.core.find(find_all=True):
-        usb_level = dev.bcdUSB >> 8
-        port_numbers = dev.port_numbers or ()
-        location = (dev.bus,) + port_numbers
+    now = time.monotonic()
+    if _PORTS_CACHE['data'] is None or now - _PORTS_CACHE['ts'] >= PORTS_CACHE_TTL:
+        _PORTS_CACHE['data'] = scan_usbports()
+        _PORTS_CACHE['ts'] = now
+    return _PORTS_CACHE['data']
+
+_STR_CACHE = {}
+
+def device_strings(dev):
+    key = (dev.bus, dev.address, dev.idVendor, dev.idProduct)
+    strings = _STR_CACHE.get(key)
+    if strings is None:
         manufacturer = device_manufacturer(dev)
         product = device_product(dev)
         if manufacturer:
             manufacturer = manufacturer.strip() 
         if product:
             product = product.strip() 
-        d = { 
-            'dev': dev,
-            'bus': dev.bus,
-            'port_number': dev.port_number,
-            'address': dev.address,
-            'vidpid': (dev.idVendor, dev.idProduct),
-            'location': location,
-            'usb_level': usb_level,
-            'serial_number': device_serial(dev),
-            'product': product,
-            'manufacturer': manufacturer,
-            'is_hub': dev.bDeviceClass == USB_CLASS_HUB,
-        }
+        strings = (manufacturer, product, device_serial(dev))
+        _STR_CACHE[key] = strings
+    return key, strings
+
+# enumerators yield (bus, address, port_numbers, vidpid, usb_level,
+# device_class, manufacturer, product, serial_number) for each device
+
+def enumerate_sysfs():
+    # the kernel keeps the descriptors and strings of every device,
+    # reading them here costs no control transfers
+    for path in glob.glob('/sys/bus/usb/devices/*'):
+        name = os.path.basename(path)
+        if ':' in name:
+            continue  # interface
+        try:
+            bus = int(sysfs_read(name, 'busnum'))
+            address = int(sysfs_read(name, 'devnum'))
+            devpath = sysfs_read(name, 'devpath')
+            port_numbers = () if devpath == '0' else tuple(
+                int(n) for n in devpath.split('.'))
+            vidpid = (
+                int(sysfs_read(name, 'idVendor'), 16),
+                int(sysfs_read(name, 'idProduct'), 16))
+            usb_level = int(sysfs_read(name, 'version').split('.')[0])
+            device_class = int(sysfs_read(name, 'bDeviceClass'), 16)
+        except (AttributeError, TypeError, ValueError):
+            continue  # device went away while reading it
+        yield (bus, address, port_numbers, vidpid, usb_level, device_class,
+               sysfs_read(name, 'manufacturer') or None,
+               sysfs_read(name, 'product') or None,
+               sysfs_read(name, 'serial') or None)
+
+def enumerate_pyusb():
+    seen = set()
+    for dev in usb.core.find(find_all=True):
+        key, (manufacturer, product, serial_number) = device_strings(dev)
+        seen.add(key)
+        yield (dev.bus, dev.address, dev.port_numbers or (),
+               (dev.idVendor, dev.idProduct), dev.bcdUSB >> 8,
+               dev.bDeviceClass, manufacturer, product, serial_number)
+    for key in set(_STR_CACHE) - seen:
+        del _STR_CACHE[key]
+
+def scan_usbports():
+    ports = []
+    index = {}
+    if os.path.isdir('/sys/bus/usb/devices'):
+        devices = enumerate_sysfs()
+    else:
+        devices = enumerate_pyusb()
+    for (bus, address, port_numbers, vidpid, usb_level, device_class,
+         manufacturer, product, serial_number) in devices:
+        location = (bus,) + port_numbers
+        d = Port(
+            bus=bus,
+            port_number=port_numbers[-1] if port_numbers else None,
+            address=address,
+            vidpid=vidpid,
+            location=location,
+            usb_level=usb_level,
+            serial_number=serial_number,
+            product=product,
+            manufacturer=manufacturer,
+            is_hub=device_class == USB_CLASS_HUB)
         ports.append(d)
-    update_hubs(ports)
-    update_comports(ports)
-    return ports
+        index[location] = d
+    update_hubs(ports, index)
+    update_comports(index)
+    return ports, index
+
+LINE_FORMAT = '{:13s} {:5s} {}'.format
 
 def describe_ports(ports):
-    ports.sort(key=lambda d: d['location'])
-    data = []
+    ports.sort(key=lambda d: d.location)
+    rows = []
     for d in ports:
-        location = d['location']
-        is_hub = d.get('is_hub')
-        port_status = d.get('port_status')
-        name = d.get('name')
-        serial_number = d.get('serial_number')
-        vidpid = d.get('vidpid')
-        manufacturer = d.get('manufacturer')
-        product = d.get('product')
-        serial_number = d.get('serial_number')
+        location = d.location
+        is_hub = d.is_hub
+        port_status = d.port_status
+        name = d.name
+        vidpid = d.vidpid
+        manufacturer = d.manufacturer
+        product = d.product
+        serial_number = d.serial_number
         ###
         if is_hub:
             product = 'Hub'
@@ -315,14 +582,12 @@ def describe_ports(ports):
         if vidpid:
             vidpid = ':'.join(f'{d:04x}' for d in vidpid)
             product = f'{vidpid} {product}'
-        port_status = '[' + ''.join(port_status or []) + ']'
+        port_status = f'[{port_status or ""}]'
         port_location = str(location[0])
-        port_numbers = '.'.join(f'{d:02d}' for d in location[1:])
-        if port_numbers:
-            port_location = f'{port_location}-{port_numbers}'
-        line = f'{port_location:13s} {port_status:5s} {product}'
-        data.append(line)
-    return data
+        if len(location) > 1:
+            port_location += '-' + '.'.join(f'{d:02d}' for d in location[1:])
+        rows.append((port_location, port_status, product))
+    return [LINE_FORMAT(*row) for row in rows]
 
 
 # INDI server
@@ -330,103 +595,203 @@ def describe_ports(ports):
 
 class Indiserver:
     BUFFER_SIZE = 4096
-
-    def _buffer_update(self, buf, text):
-        d = text.split('\n')
-        if not buf:
-            buf.append('')
-        buf[-1] = buf[-1] + d[0]
-        buf.extend(d[1:])           
-                
-    def _buffer_parse(self, buf):
-        n = 0
-        for i in range(len(buf)):
-            try:
-                text = '\n'.join(buf[n:i+1])
-                root = ET.fromstring(text)
+    MAX_OUTBUF = 1 << 20  # drop clients that fall this far behind
+
+    def _new_parser(self):
+        # wrap the stream of messages in a single document so that
+        # each message completes as a child of the wrapper element
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        # the parser decodes the raw bytes received, as latin like before
+        parser.feed(b"<?xml version='1.0' encoding='iso-8859-1'?><indi>")
+        _, wrapper = next(parser.read_events())
+        return parser, wrapper
+
+    def _parse(self, s, data):
+        parser, wrapper = self._parsers[s]
+        parser.feed(data)
+        for event, root in parser.read_events():
+            # completed messages are removed, so an open message is first
+            if event == 'end' and len(wrapper) and wrapper[0] is root:
+                wrapper.remove(root)
                 if self.verbose:
                     print('------- parse -------')
-                    print(text)
+                    print(ET.tostring(root, encoding='unicode'))
                 yield root
-                n = i + 1
-            except ET.ParseError:
-                pass
-        del buf[:n]
 
     def _accept_conn(self, conn):
         s = conn.accept()[0]
-        self._socklist.append(s)
-        self._readbuf[s] = []
+        s.setblocking(0)
+        self._clients[s.fileno()] = s
+        self._parsers[s] = self._new_parser()
+        self._outbuf[s] = bytearray()
+        self._epoll.register(s, select.EPOLLIN | select.EPOLLERR)
 
     def _close_conn(self, s):
-        self._socklist.remove(s)
-        del self._readbuf[s]
+        if s not in self._parsers:
+            return  # already closed
+        self._epoll.unregister(s)
+        del self._clients[s.fileno()]
+        del self._parsers[s]
+        del self._outbuf[s]
+        self._writing.discard(s)
         s.close()
 
-    def publish(self, root):
-        if self._socklist:
-            ET.indent(root)
-            payload = ET.tostring(root, encoding='latin', xml_declaration=False)
-            payload += b'\n'
+    def _read_conn(self, s):
+        try:
+            n = s.recv_into(self._recvbuf)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            n = 0
+        if not n:
+            self._close_conn(s)
+            return
+        try:
+            for root in self._parse(s, self._recvview[:n]):
+                self.on_message(root)
+                if s not in self._parsers:
+                    return  # publish dropped this client
+        except ET.ParseError:
+            # the stream cannot resync after malformed xml
+            self._close_conn(s)
+
+    def _flush_conn(self, s):
+        buf = self._outbuf[s]
+        try:
+            while buf:
+                n = s.send(buf)
+                del buf[:n]
+        except BlockingIOError:
+            pass
+        except ConnectionError:
+            self._close_conn(s)
+            return
+        # only ask for writable events while a client has a backlog
+        if buf and s not in self._writing:
+            self._writing.add(s)
+            self._epoll.modify(s, select.EPOLLIN | select.EPOLLOUT | select.EPOLLERR)
+        elif not buf and s in self._writing:
+            self._writing.discard(s)
+            self._epoll.modify(s, select.EPOLLIN | select.EPOLLERR)
+
+    def _usb_monitor(self):
+        # netlink notifications of usb devices coming and going
+        if pyudev is None:
+            return None
+        try:
+            monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            monitor.filter_by(subsystem='usb', device_type='usb_device')
+            monitor.start()
+        except (OSError, ImportError) as e:
+            # no libudev or netlink access, e.g. inside a container
+            print(f'usb monitor unavailable: {e}', file=sys.stderr)
+            return None
+        return monitor
+
+    def _usb_changed(self, monitor):
+        while monitor.poll(timeout=0) is not None:
+            pass
+        try:
+            invalidate_usbports()
+            self.update_values()
+        except Exception:
+            print(traceback.format_exc().strip(), file=sys.stderr)
+            return
+        self.publish(self.set_property())
+
+    def publish(self, text):
+        if self._clients:
+            payload = text.encode('latin', 'xmlcharrefreplace') + b'\n'
             if self.verbose:
                 print('----- server_publish ------')
                 print(payload.decode(), end='')
-            for s in self._socklist:
-                s.sendall(payload)
+            # queued here and sent once the current events are handled,
+            # so back to back publishes go out in a single send
+            for s in list(self._clients.values()):
+                buf = self._outbuf[s]
+                if len(buf) + len(payload) > self.MAX_OUTBUF:
+                    # give the client a chance to take what it can first
+                    self._flush_conn(s)
+                    if s not in self._parsers:
+                        continue
+                if len(buf) + len(payload) > self.MAX_OUTBUF:
+                    self._close_conn(s)
+                else:
+                    buf += payload
 
     def loop(self, host, port):
-        self._readbuf = {}
-        self._socklist = []
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn:
+        self._parsers = {}
+        self._clients = {}
+        self._outbuf = {}
+        self._writing = set()
+        # one receive buffer serves every client, it is parsed right away
+        self._recvbuf = bytearray(self.BUFFER_SIZE)
+        self._recvview = memoryview(self._recvbuf)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as conn, \
+             select.epoll() as self._epoll:
             conn.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             conn.setblocking(0)  # set non-blocking mode
             conn.bind((host, port))
             conn.listen(5)
+            self._epoll.register(conn, select.EPOLLIN)
+            monitor = self._usb_monitor()
+            if monitor:
+                self._epoll.register(monitor, select.EPOLLIN)
             while True:
-                read_s, write_s, error_s = select.select(self._socklist + [conn], [], self._socklist, 1)
-                for s in error_s:
-                    self._close_conn(s)
-                for s in read_s:
-                    if s == conn:
-                        self._accept_conn(s)
-                    else:
-                        chunk = s.recv(self.BUFFER_SIZE)
-                        if chunk:
-                            text = chunk.decode('latin')
-                            self._buffer_update(self._readbuf[s], text)
-                            for root in self._buffer_parse(self._readbuf[s]):
-                                self.on_message(root)
-                        else:
-                            self._close_conn(s)
+                for fd, event in self._epoll.poll():
+                    if fd == conn.fileno():
+                        self._accept_conn(conn)
+                        continue
+                    if monitor and fd == monitor.fileno():
+                        self._usb_changed(monitor)
+                        continue
+                    s = self._clients.get(fd)
+                    if s is None:
+                        continue
+                    if event & select.EPOLLERR:
+                        self._close_conn(s)
+                    elif event & select.EPOLLIN:
+                        self._read_conn(s)
+                for s in list(self._clients.values()):
+                    if self._outbuf[s]:
+                        self._flush_conn(s)
+
+    def _vector_prefixes(self):
+        # the vector header apart from state and message never changes,
+        # and the element tags only change with the number of values
+        self._set_head = f'<setTextVector name="{quote_attr(self.name)}" state="'
+        self._def_head = (
+            f'<defTextVector perm="rw" group="{quote_attr(self.group)}" '
+            f'name="{quote_attr(self.name)}" state="')
+        self._device_attr = f' device="{quote_attr(self.device)}">'
+        self._one_text = []
+        self._def_text = []
+
+    def _text_prefixes(self):
+        if len(self._one_text) != len(self.values):
+            names = [quote_attr(d['name']) for d in self.values]
+            self._one_text = [f'  <oneText name="{name}">' for name in names]
+            self._def_text = [
+                f'  <defText name="{name}" label="{name}">' for name in names]
 
     def set_property(self):
-        attrib = { 
-            'name': self.name, 
-            'state': self.state
-        }
-        if self.message:
-            attrib['message'] = self.message
-        root = ET.Element(f'setTextVector', attrib=attrib, device=self.device)
-        for d in self.values:
-            attrib = { 'name': d['name'] }
-            el = ET.SubElement(root, f'oneText', attrib=attrib)
-            el.text = d['value']
-        return root
+        self._text_prefixes()
+        message = f' message="{quote_attr(self.message)}"' if self.message else ''
+        data = [
+            f'{self._set_head}{quote_attr(self.state)}"{message}{self._device_attr}'
+        ]
+        for prefix, d in zip(self._one_text, self.values):
+            data.append(f'{prefix}{escape(d["value"])}</oneText>')
+        data.append('</setTextVector>')
+        return '\n'.join(data)
 
     def define_property(self):
-        attrib = { 
-            'perm': 'rw', 
-            'group': self.group, 
-            'name': self.name,
-            'state': self.state
-        }
-        root = ET.Element(f'defTextVector', attrib=attrib, device=self.device)
-        for d in self.values:
-            name = d['name']
-            attrib = { 'name': name, 'label': name }
-            el = ET.SubElement(root, f'defText', attrib=attrib)
-            el.text = str(d['value'])
-        return root
+        self._text_prefixes()
+        data = [f'{self._def_head}{quote_attr(self.state)}"{self._device_attr}']
+        for prefix, d in zip(self._def_text, self.values):
+            data.append(f'{prefix}{escape(str(d["value"]))}</defText>')
+        data.append('</defTextVector>')
+        return '\n'.join(data)
 
     ###
 
@@ -436,12 +801,14 @@ class Indiserver:
         self.name = 'PORT'
         self.state = 'Ok'
         self.group = 'Main Control'
+        self.message = None
         self.length = None
         self.verbose = verbose
+        self._vector_prefixes()
         self.update_values()
 
     def update_values(self):
-        ports = list_usbports()
+        ports, _ = list_usbports()
         arr = describe_ports(ports)
         if self.length is None:
             self.length = len(arr) + 8
@@ -581,42 +948,96 @@ def parse_args():
     group.add_argument('--indi-port', metavar='PORT', type=int, default=7624, help='INDI server port')
     return parser.parse_args()
 
-def soft_reset(location):
-    location = parse_location(location)
-    ports = list_usbports()
-    d = find(ports, 'location', location)
+def device_filename(location):
+    # resolve through sysfs when available rather than enumerating usb
+    if os.path.isdir('/sys/bus/usb/devices'):
+        dev = sysfs_device(location)
+        if dev is None:
+            hub = sysfs_device(location[:-1]) if len(location) > 1 else None
+            if hub is None or not 1 <= location[-1] <= hub[2]:
+                raise ValueError('bad usb port location, port not found')
+            raise ValueError('usb device not enumerated or plugged in')
+        return usb_filename(dev[0], dev[1])
+    _, index = list_usbports()
+    d = index.get(location)
     if d is None:
         raise ValueError('bad usb port location, port not found')
-    if 'dev' not in d:
+    if d.vidpid is None:
         raise ValueError('usb device not enumerated or plugged in')
-    with open(usb_filename(d['dev']), 'w+') as fd:
+    return usb_filename(d.bus, d.address)
+
+def hub_address(location):
+    if len(location) < 2:
+        raise ValueError('bad usb port location, port not found')
+    if os.path.isdir('/sys/bus/usb/devices'):
+        hub = sysfs_device(location[:-1])
+        if hub is None or not 1 <= location[-1] <= hub[2]:
+            raise ValueError('bad usb port location, port not found')
+        return hub[0], hub[1]
+    _, index = list_usbports()
+    d = index.get(location)
+    if d is None:
+        raise ValueError('bad usb port location, port not found')
+    d = index.get(location[:-1])
+    if d is None or not d.is_hub:
+        raise ValueError('hub not found, internal error')
+    return d.bus, d.address
+
+def update_port_status(location, bus, address):
+    # only the commanded port can have changed, so patch its status in
+    # the cached enumeration instead of rescanning every device
+    if _PORTS_CACHE['data'] is None:
+        return
+    _, index = _PORTS_CACHE['data']
+    hub = index.get(location[:-1])
+    d = index.get(location)
+    if hub is None or d is None or (hub.bus, hub.address) != (bus, address):
+        invalidate_usbports()
+        return
+    fd = hub_file(bus, address)
+    d.port_status = usb_hub_port_status(fd, location[-1], hub.usb_level)
+
+def soft_reset(location):
+    location = parse_location(location)
+    filename = device_filename(location)
+    invalidate_usbports()
+    with open(filename, 'w+') as fd:
         usb_reset(fd)
 
 def set_feature(location, feature, value):
     location = parse_location(location)
-    ports = list_usbports()
-    d = find(ports, 'location', location)
-    if d is None or len(location) < 2:
-        raise ValueError('bad usb port location, port not found')
-    d = find(ports, 'location', location[:-1])
-    if d is None or not d.get('is_hub'):
-        raise ValueError('hub not found, internal error')
-    with open(usb_filename(d['dev']), 'w+') as fd:
-        usb_hub_feature(fd, location[-1], feature, value)
+    bus, address = hub_address(location)
+    try:
+        fd = hub_file(bus, address)
+        usb_forbid_suspend(fd)
+        try:
+            usb_hub_feature(fd, location[-1], feature, value)
+            if feature == USB_PORT_FEAT_POWER and value:
+                update_port_status(location, bus, address)
+            else:
+                # the device on the port detaches or re-enumerates
+                invalidate_usbports()
+        finally:
+            usb_allow_suspend(fd)
+    except OSError:
+        close_hub_file(bus, address)
+        invalidate_usbports()
+        raise
 
 def disable_port(location):
     location = parse_location(location)
-    ports = list_usbports()
-    d = find(ports, 'location', location)
+    _, index = list_usbports()
+    d = index.get(location)
     if d is None or len(location) < 2:
         raise ValueError('bad usb port location, port not found')
-    d = find(ports, 'location', location[:-1])
-    if d is None or not d.get('is_hub'):
+    d = index.get(location[:-1])
+    if d is None or not d.is_hub:
         raise ValueError('bad usb port location, hub not found')
-    return usb_disable_port(d['dev'], location[-1])
+    invalidate_usbports()
+    return usb_disable_port(location)
 
 def show_ports():
-    ports = list_usbports()
+    ports, _ = list_usbports()
     arr = describe_ports(ports)
     text = '\n'.join(arr)
     return text